@@ -1,13 +1,23 @@
 import os
 import time
+import asyncio
+import weakref
+import json
+import heapq
 import logging
-import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from pydantic import Field
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 
 from proconfig.widgets.base import WIDGETS, BaseWidget
 from apify_client import ApifyClient
 
+# 区分“记录中没有value字段”和“value为None”
+_MISSING = object()
+
 @WIDGETS.register_module()
 class ApifyKVStoreWidget(BaseWidget):
     """
@@ -17,6 +27,57 @@ class ApifyKVStoreWidget(BaseWidget):
     CATEGORY = "Custom Widgets/Data Tools"
     NAME = "Apify KV Store"
     
+    # 日期时间格式；键为纳秒时间戳，旧数据的键为秒级时间戳（大于该阈值视为纳秒）
+    _DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+    _NS_KEY_THRESHOLD = 10 ** 12
+    
+    # 本进程最近一次生成的上传键，保证键严格递增
+    _last_key_ns = 0
+    _key_lock = threading.Lock()
+    
+    # 首次读取后缓存的APIFY_API_KEY
+    _api_key: Optional[str] = None
+    _api_key_lock = threading.Lock()
+    
+    # 按API密钥缓存客户端，复用底层HTTP连接池
+    _client_cache: Dict[str, ApifyClient] = {}
+    _client_lock = threading.Lock()
+    
+    # 按(API密钥, 存储名称)缓存存储ID，避免每次调用都查询
+    _store_id_cache: Dict[Tuple[str, str], str] = {}
+    _store_id_lock = threading.Lock()
+    
+    # 最新时间戳键的短期缓存（写入时间, 请求数量, 键列表）；同一存储的并发调用合并为一次遍历。
+    # 最多缓存_LIST_KEYS_MAXSIZE个存储，按存储散列到固定数量的锁上，两者都不会随存储数量增长
+    _LIST_KEYS_TTL = 5.0
+    _LIST_KEYS_MIN = 100
+    _LIST_KEYS_MAXSIZE = 128
+    _list_keys_cache: Dict[Tuple[str, str], Tuple[float, int, List[int]]] = {}
+    _list_keys_cache_lock = threading.Lock()
+    _list_keys_locks = [threading.Lock() for _ in range(64)]
+    
+    # 已获取记录的LRU缓存（记录, 值大小）；时间戳键写入后不再修改，可安全长期缓存。
+    # 同时按条目数和值的总大小限制，超过_RECORD_CACHE_MAX_VALUE_BYTES的值不缓存
+    _RECORD_CACHE_SIZE = 4096
+    _RECORD_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    _RECORD_CACHE_MAX_VALUE_BYTES = 1024 * 1024
+    _record_cache: "OrderedDict[Tuple[str, str], Tuple[Dict[str, Any], int]]" = OrderedDict()
+    _record_cache_bytes = 0
+    _record_cache_lock = threading.Lock()
+    
+    # 共享的记录获取线程池（线程按需创建）
+    _fetch_executor = ThreadPoolExecutor(max_workers=16)
+    
+    # execute_async获取记录的参数：并发上限与线程池一致，429/5xx/网络错误按指数退避重试
+    _APIFY_API_BASE_URL = "https://api.apify.com/v2/"
+    _ASYNC_MAX_CONCURRENCY = 16
+    _ASYNC_MAX_RETRIES = 4
+    _ASYNC_RETRY_DELAY = 0.5
+    
+    # 每个事件循环共用一个异步HTTP客户端和并发信号量（AsyncClient不能跨事件循环复用），
+    # 事件循环关闭时（shutdown_asyncgens）关闭客户端
+    _async_states: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+    
     class InputsSchema(BaseWidget.InputsSchema):
         operation: str = Field("download", description="操作类型 (upload/download)")
         store_name: str = Field("default-store", description="KV存储名称")
@@ -29,6 +90,362 @@ class ApifyKVStoreWidget(BaseWidget):
         data: List[str] = Field([], description="下载的数据列表，最新的在前")
         dates: List[str] = Field([], description="数据对应的日期时间列表，与data列表顺序一致")
     
+    @classmethod
+    def _get_api_key(cls) -> Optional[str]:
+        """读取环境变量APIFY_API_KEY并缓存；未设置时不缓存，以便之后设置仍能生效"""
+        if cls._api_key is None:
+            with cls._api_key_lock:
+                if cls._api_key is None:
+                    cls._api_key = os.environ.get("APIFY_API_KEY") or None
+        return cls._api_key
+    
+    @classmethod
+    def _reset_api_key_cache(cls):
+        """清除缓存的API密钥（用于测试或更换密钥）"""
+        with cls._api_key_lock:
+            cls._api_key = None
+    
+    @classmethod
+    def _get_client(cls, api_key: str) -> ApifyClient:
+        """获取（或创建并缓存）指定API密钥对应的Apify客户端"""
+        client = cls._client_cache.get(api_key)
+        if client is None:
+            with cls._client_lock:
+                client = cls._client_cache.get(api_key)
+                if client is None:
+                    client = ApifyClient(api_key)
+                    cls._client_cache[api_key] = client
+        return client
+    
+    @classmethod
+    def _resolve_store_id(cls, api_key: str, store_name: str) -> str:
+        """获取（或创建）指定名称的KV存储，返回缓存的存储ID"""
+        cache_key = (api_key, store_name)
+        store_id = cls._store_id_cache.get(cache_key)
+        if store_id is None:
+            store = cls._get_client(api_key).key_value_stores().get_or_create(name=store_name)
+            store_id = store["id"]
+            with cls._store_id_lock:
+                cls._store_id_cache[cache_key] = store_id
+        return store_id
+    
+    @classmethod
+    def _forget_store_id(cls, api_key: str, store_name: str):
+        """清除缓存的存储ID（存储已被删除时调用）"""
+        with cls._store_id_lock:
+            cls._store_id_cache.pop((api_key, store_name), None)
+    
+    def _run_on_store(self, api_key: str, store_name: str, fn):
+        """
+        解析存储ID后调用fn(kv, store_id)并返回其结果
+        
+        缓存的存储ID可能对应已被删除的存储：操作返回404时清除缓存，重新获取或创建存储后重试一次。
+        """
+        client = self._get_client(api_key)
+        for attempt in range(2):
+            store_id = self._resolve_store_id(api_key, store_name)
+            try:
+                return fn(client.key_value_store(store_id), store_id)
+            except Exception as e:
+                if attempt or getattr(e, "status_code", None) != 404:
+                    raise
+                self._forget_store_id(api_key, store_name)
+                self._invalidate_list_keys(api_key, store_id)
+    
+    @staticmethod
+    def _iter_numeric_keys(kv):
+        """逐页遍历存储中的键，只产出时间戳键（转换为整数），不在内存中保留完整列表"""
+        exclusive_start_key = None
+        while True:
+            page = kv.list_keys(limit=1000, exclusive_start_key=exclusive_start_key)
+            for item in page["items"]:
+                if item["key"].isdigit():
+                    yield int(item["key"])
+            if not page.get("isTruncated") or not page["items"]:
+                break
+            exclusive_start_key = page.get("nextExclusiveStartKey") or page["items"][-1]["key"]
+    
+    @classmethod
+    def _list_keys_lock(cls, cache_key: Tuple[str, str]) -> threading.Lock:
+        """返回指定存储的键列表缓存锁（同一存储始终对应同一把锁）"""
+        return cls._list_keys_locks[hash(cache_key) % len(cls._list_keys_locks)]
+    
+    @classmethod
+    def _invalidate_list_keys(cls, api_key: str, store_id: str):
+        """
+        使指定存储的键列表缓存失效
+        
+        在同一把锁下清除，确保上传前已开始的遍历不会在清除之后写回旧结果。
+        """
+        cache_key = (api_key, store_id)
+        with cls._list_keys_lock(cache_key), cls._list_keys_cache_lock:
+            cls._list_keys_cache.pop(cache_key, None)
+    
+    @classmethod
+    def _store_list_keys(cls, cache_key: Tuple[str, str], entry: Tuple[float, int, List[int]]):
+        """写入键列表缓存，同时清除过期条目；超过_LIST_KEYS_MAXSIZE时淘汰最早写入的条目"""
+        with cls._list_keys_cache_lock:
+            cache = cls._list_keys_cache
+            cache.pop(cache_key, None)
+            now = entry[0]
+            expired = [key for key, cached in cache.items()
+                       if now - cached[0] >= cls._LIST_KEYS_TTL]
+            for key in expired:
+                del cache[key]
+            while len(cache) >= cls._LIST_KEYS_MAXSIZE:
+                del cache[next(iter(cache))]
+            cache[cache_key] = entry
+    
+    @classmethod
+    def _list_latest_keys(cls, kv, api_key: str, store_id: str, count: int) -> List[int]:
+        """
+        返回存储中最新的count个时间戳键（整数，降序），结果缓存_LIST_KEYS_TTL秒
+        
+        每个存储一把锁：只有一个调用者真正发出请求，其余调用者等待并复用结果。
+        缓存有效期内不会访问API，因此存储被删除后最多_LIST_KEYS_TTL秒内仍可能返回其旧键。
+        """
+        cache_key = (api_key, store_id)
+        with cls._list_keys_lock(cache_key):
+            cached = cls._list_keys_cache.get(cache_key)
+            if (cached is not None and time.monotonic() - cached[0] < cls._LIST_KEYS_TTL
+                    and cached[1] >= count):
+                return cached[2][:count]
+            
+            # 至少保留_LIST_KEYS_MIN个键，使不同max_items的下载共用同一份缓存
+            limit = max(count, cls._LIST_KEYS_MIN)
+            keys = heapq.nlargest(limit, cls._iter_numeric_keys(kv))
+            cls._store_list_keys(cache_key, (time.monotonic(), limit, keys))
+            return keys[:count]
+    
+    @classmethod
+    def _lookup_cached_records(cls, store_id: str,
+                               keys: List[str]) -> Tuple[List[Optional[Dict[str, Any]]], List[int]]:
+        """从记录缓存中查找，返回（按keys顺序的记录列表，未命中的下标列表）"""
+        records: List[Optional[Dict[str, Any]]] = [None] * len(keys)
+        missing = []
+        with cls._record_cache_lock:
+            for i, key in enumerate(keys):
+                cached = cls._record_cache.get((store_id, key))
+                if cached is None:
+                    missing.append(i)
+                else:
+                    cls._record_cache.move_to_end((store_id, key))
+                    records[i] = cached[0]
+        return records, missing
+    
+    @staticmethod
+    def _record_value_size(record: Dict[str, Any]) -> int:
+        """估算记录值占用的字节数（非字符串/二进制的值按JSON序列化后的长度计算）"""
+        value = record.get("value")
+        if isinstance(value, str):
+            return len(value.encode("utf-8"))
+        if isinstance(value, (bytes, bytearray)):
+            return len(value)
+        return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+    
+    @classmethod
+    def _fill_records(cls, store_id: str, keys: List[str], records: List[Optional[Dict[str, Any]]],
+                      missing: List[int], fetched: List[Optional[Dict[str, Any]]]):
+        """将新获取的记录填入结果列表并写入缓存"""
+        with cls._record_cache_lock:
+            for i, record in zip(missing, fetched):
+                records[i] = record
+                if record is None:
+                    continue
+                size = cls._record_value_size(record)
+                if size > cls._RECORD_CACHE_MAX_VALUE_BYTES:
+                    continue
+                
+                previous = cls._record_cache.pop((store_id, keys[i]), None)
+                if previous is not None:
+                    cls._record_cache_bytes -= previous[1]
+                cls._record_cache[(store_id, keys[i])] = (record, size)
+                cls._record_cache_bytes += size
+                while (len(cls._record_cache) > cls._RECORD_CACHE_SIZE
+                        or cls._record_cache_bytes > cls._RECORD_CACHE_MAX_BYTES):
+                    _, (_, evicted_size) = cls._record_cache.popitem(last=False)
+                    cls._record_cache_bytes -= evicted_size
+    
+    @classmethod
+    def _fetch_records(cls, kv, store_id: str, keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """
+        批量获取多个键的记录，结果顺序与keys一致
+        
+        已缓存的记录直接返回；Apify没有一次读取多条记录的接口，因此其余请求在共享线程池中一次性提交。
+        """
+        records, missing = cls._lookup_cached_records(store_id, keys)
+        if missing:
+            fetched = list(cls._fetch_executor.map(kv.get_record, [keys[i] for i in missing]))
+            cls._fill_records(store_id, keys, records, missing, fetched)
+        return records
+    
+    @classmethod
+    async def _fetch_record_async(cls, http: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                                  api_key: str, store_id: str,
+                                  key: str) -> Optional[Dict[str, Any]]:
+        """通过Apify REST API异步获取单条记录，不存在时返回None；限流、服务端错误和网络错误时退避重试"""
+        for attempt in range(cls._ASYNC_MAX_RETRIES + 1):
+            try:
+                async with semaphore:
+                    response = await http.get(
+                        f"key-value-stores/{store_id}/records/{key}",
+                        headers={"Authorization": f"Bearer {api_key}"},
+                    )
+                if response.status_code == 404:
+                    return None
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    break
+                if attempt == cls._ASYNC_MAX_RETRIES:
+                    response.raise_for_status()
+            except httpx.TransportError:
+                if attempt == cls._ASYNC_MAX_RETRIES:
+                    raise
+            await asyncio.sleep(cls._ASYNC_RETRY_DELAY * 2 ** attempt)
+        
+        content_type = response.headers.get("content-type", "")
+        if "application/json" in content_type:
+            value = response.json()
+        elif content_type.startswith("text/") or "xml" in content_type:
+            value = response.text
+        else:
+            value = response.content
+        return {"key": key, "value": value, "content_type": content_type}
+    
+    @classmethod
+    async def _fetch_records_async(cls, api_key: str, store_id: str,
+                                   keys: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """
+        _fetch_records的异步版本，未缓存的记录在当前事件循环上并发获取
+        
+        同一事件循环上的所有调用共用一个HTTP客户端（复用连接）和一个并发信号量。
+        """
+        records, missing = cls._lookup_cached_records(store_id, keys)
+        if missing:
+            http, semaphore = await cls._get_async_state()
+            fetched = await asyncio.gather(*[
+                cls._fetch_record_async(http, semaphore, api_key, store_id, keys[i])
+                for i in missing
+            ])
+            cls._fill_records(store_id, keys, records, missing, fetched)
+        return records
+    
+    @classmethod
+    async def _get_async_state(cls) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """返回当前事件循环的（异步HTTP客户端, 并发信号量），首次调用时创建"""
+        loop = asyncio.get_running_loop()
+        state = cls._async_states.get(loop)
+        if state is None:
+            http = httpx.AsyncClient(
+                base_url=cls._APIFY_API_BASE_URL,
+                limits=httpx.Limits(max_connections=cls._ASYNC_MAX_CONCURRENCY),
+            )
+            lifetime = cls._async_client_lifetime(http)
+            await lifetime.__anext__()
+            state = (http, asyncio.Semaphore(cls._ASYNC_MAX_CONCURRENCY), lifetime)
+            cls._async_states[loop] = state
+        return state[0], state[1]
+    
+    @classmethod
+    async def _async_client_lifetime(cls, http: httpx.AsyncClient):
+        """
+        持有异步HTTP客户端直到事件循环关闭
+        
+        事件循环会登记已启动的异步生成器，并在shutdown_asyncgens（asyncio.run结束时调用）中
+        将其关闭，此时执行finally关闭客户端并移除该事件循环的状态。
+        """
+        try:
+            yield http
+        finally:
+            cls._async_states.pop(asyncio.get_running_loop(), None)
+            await http.aclose()
+    
+    @classmethod
+    def _next_timestamp_key(cls) -> str:
+        """生成纳秒时间戳键；时钟精度不足或回拨时顺延1纳秒，避免同一进程内的键重复"""
+        with cls._key_lock:
+            ns = max(time.time_ns(), cls._last_key_ns + 1)
+            cls._last_key_ns = ns
+        return str(ns)
+    
+    @classmethod
+    def _format_key_date(cls, key: str) -> str:
+        """将时间戳键转换为本地日期时间字符串，兼容秒级和纳秒级时间戳；无法转换时返回“未知日期”"""
+        try:
+            ts = int(key)
+            if ts >= cls._NS_KEY_THRESHOLD:
+                ts //= 1_000_000_000
+            return time.strftime(cls._DATE_FORMAT, time.localtime(ts))
+        except (ValueError, TypeError, OverflowError, OSError):
+            return "未知日期"
+    
+    def _do_upload(self, kv, api_key: str, store_id: str, config) -> Dict[str, Any]:
+        """以当前时间戳为键上传值"""
+        if not config.value:
+            return {
+                "success": False,
+                "message": "上传操作需要提供值",
+                "data": [],
+                "dates": []
+            }
+        
+        # 使用当前纳秒时间戳作为键，同一秒内的多次上传不会互相覆盖
+        timestamp = self._next_timestamp_key()
+        current_date = self._format_key_date(timestamp)
+        
+        # 存储值
+        kv.set_record(timestamp, config.value)
+        # 存储内容已变化，使键列表缓存失效
+        self._invalidate_list_keys(api_key, store_id)
+        
+        return {
+            "success": True,
+            "message": f"成功上传数据，键为 {timestamp}",
+            "data": [config.value],
+            "dates": [current_date]
+        }
+    
+    def _select_latest_keys(self, kv, api_key: str, store_id: str, max_items: int) -> List[str]:
+        """返回最新的max_items个时间戳键，最新的在前"""
+        # 按时间戳数值取最新的n个记录（降序，最新的在前），无需对全部键排序
+        keys = self._list_latest_keys(kv, api_key, store_id, max_items)
+        return [str(key) for key in keys]
+    
+    def _build_download_result(self, latest_keys: List[str],
+                               records: List[Optional[Dict[str, Any]]]) -> Dict[str, Any]:
+        """将键和对应记录组装为下载结果"""
+        # 在组装结果前一次性将键转换为日期时间
+        key_dates = [self._format_key_date(key) for key in latest_keys]
+        
+        values_list = []
+        dates_list = []
+        for date, record in zip(key_dates, records):
+            value = (record or {}).get("value", _MISSING)
+            if value is not _MISSING:
+                values_list.append(value)
+                dates_list.append(date)
+        
+        return {
+            "success": True,
+            "message": f"成功获取最新的 {len(values_list)} 条记录",
+            "data": values_list,
+            "dates": dates_list
+        }
+    
+    def _do_download(self, kv, api_key: str, store_id: str, config) -> Dict[str, Any]:
+        """获取最新的max_items条记录，最新的在前"""
+        latest_keys = self._select_latest_keys(kv, api_key, store_id, config.max_items)
+        
+        # 批量并发获取记录，总耗时取决于最慢的单个请求
+        records = self._fetch_records(kv, store_id, latest_keys)
+        return self._build_download_result(latest_keys, records)
+    
+    # 操作类型（小写）到处理方法的映射
+    _OPERATIONS = {
+        "upload": _do_upload,
+        "download": _do_download,
+    }
+    
     def execute(self, environ, config):
         """
         执行Apify KV存储操作
@@ -42,7 +459,7 @@ class ApifyKVStoreWidget(BaseWidget):
         """
         try:
             # 从环境变量获取Apify API密钥
-            apify_api_key = os.environ.get("APIFY_API_KEY")
+            apify_api_key = self._get_api_key()
             
             # 如果环境变量中没有API密钥，返回错误
             if not apify_api_key:
@@ -53,75 +470,61 @@ class ApifyKVStoreWidget(BaseWidget):
                     "dates": []
                 }
             
-            # 创建Apify客户端
-            client = ApifyClient(apify_api_key)
-            
-            # 获取或创建KV存储
-            store = client.key_value_stores().get_or_create(name=config.store_name)
-            store_id = store["id"]
-            
-            # 根据操作类型执行不同的逻辑
-            if config.operation.lower() == "upload":
-                if not config.value:
-                    return {
-                        "success": False,
-                        "message": "上传操作需要提供值",
-                        "data": [],
-                        "dates": []
-                    }
-                
-                # 使用当前时间戳作为键
-                timestamp = str(int(time.time()))
-                current_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                # 存储值
-                client.key_value_store(store_id).set_record(timestamp, config.value)
-                
-                return {
-                    "success": True,
-                    "message": f"成功上传数据，键为 {timestamp}",
-                    "data": [config.value],
-                    "dates": [current_date]
-                }
-                
-            elif config.operation.lower() == "download":
-                # 获取存储中的所有键
-                list_result = client.key_value_store(store_id).list_keys()
-                keys = [item["key"] for item in list_result["items"] if item["key"].isdigit()]
-                
-                # 按时间戳排序（降序，最新的在前）
-                keys.sort(reverse=True)
-                
-                # 获取最新的n个记录
-                latest_keys = keys[:config.max_items]
-                values_list = []
-                dates_list = []
-                
-                for key in latest_keys:
-                    record = client.key_value_store(store_id).get_record(key)
-                    if record and "value" in record:
-                        values_list.append(record["value"])
-                        # 将时间戳转换为日期时间
-                        try:
-                            dt = datetime.datetime.fromtimestamp(int(key))
-                            dates_list.append(dt.strftime("%Y-%m-%d %H:%M:%S"))
-                        except (ValueError, TypeError):
-                            dates_list.append("未知日期")
-                
-                return {
-                    "success": True,
-                    "message": f"成功获取最新的 {len(values_list)} 条记录",
-                    "data": values_list,
-                    "dates": dates_list
-                }
-                
-            else:
+            # 根据操作类型选择处理方法
+            handler = self._OPERATIONS.get(config.operation.lower())
+            if handler is None:
                 return {
                     "success": False,
                     "message": f"不支持的操作类型: {config.operation}",
                     "data": [],
                     "dates": []
                 }
+            
+            # 获取或创建KV存储并执行操作
+            return self._run_on_store(
+                apify_api_key, config.store_name,
+                lambda kv, store_id: handler(self, kv, apify_api_key, store_id, config)
+            )
+                
+        except Exception as e:
+            # 记录错误并处理
+            logging.error(f"Apify KV存储操作失败: {repr(e)}")
+            return {
+                "success": False,
+                "message": f"操作失败: {repr(e)}",
+                "data": [],
+                "dates": []
+            }
+    
+    async def execute_async(self, environ, config):
+        """
+        execute的异步版本，供能够await的调用方使用
+        
+        下载时记录在事件循环上通过httpx并发获取，不占用线程池。存储解析和键选择复用
+        带锁的同步缓存，仍在一次asyncio.to_thread中执行（缓存命中时不发出请求）；
+        其余操作（及缺少API密钥等情况）在线程中交给execute处理。
+        
+        Args:
+            environ: 环境变量
+            config: 配置参数
+        
+        Returns:
+            包含操作结果的字典
+        """
+        apify_api_key = self._get_api_key()
+        if not apify_api_key or config.operation.lower() != "download":
+            return await asyncio.to_thread(self.execute, environ, config)
+        
+        try:
+            store_id, latest_keys = await asyncio.to_thread(
+                self._run_on_store, apify_api_key, config.store_name,
+                lambda kv, store_id: (
+                    store_id,
+                    self._select_latest_keys(kv, apify_api_key, store_id, config.max_items),
+                )
+            )
+            records = await self._fetch_records_async(apify_api_key, store_id, latest_keys)
+            return self._build_download_result(latest_keys, records)
                 
         except Exception as e:
             # 记录错误并处理